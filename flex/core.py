@@ -1,38 +1,119 @@
 import os
 import yaml
 import sys
-import inspect
+import time
+import logging
 import collections
-from StringIO import StringIO
-from flask import current_app, json, _app_ctx_stack, request as flask_request
+from io import BytesIO
+from flask import current_app, json, g, request as flask_request
 from werkzeug.local import LocalProxy
-from jinja2 import BaseLoader, ChoiceLoader, TemplateNotFound
+from jinja2 import BaseLoader, ChoiceLoader, FileSystemBytecodeCache, TemplateNotFound
 from datetime import datetime
 import aniso8601
 from functools import wraps, partial
 from . import logger
 from .convert import to_date, to_time, to_timedelta
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    from flask.json.provider import DefaultJSONProvider
+
+    class _OrjsonProvider(DefaultJSONProvider):
+        """JSON provider backed by orjson when it's installed."""
+
+        def dumps(self, obj, **kwargs):
+            # mirror DefaultJSONProvider semantics so installing Flex is
+            # behavior-neutral for the host app's other routes
+            kwargs.setdefault('default', self.default)
+            kwargs.setdefault('sort_keys', self.sort_keys)
+            # route datetimes through default too, so they keep Flask's
+            # http_date format instead of orjson's native ISO output
+            option = orjson.OPT_PASSTHROUGH_DATETIME
+            if kwargs['sort_keys']:
+                option |= orjson.OPT_SORT_KEYS
+            if kwargs.get('indent'):
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=kwargs['default'], option=option).decode('utf-8')
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
 _converters = {'date': to_date, 'time': to_time, 'timedelta': to_timedelta}
 
+# local alias so the hot path skips the module attribute lookup
+_parse_datetime = aniso8601.parse_datetime
+
+# everything the request path needs for one intent, behind a single lookup
+_IntentSpec = collections.namedtuple('_IntentSpec', ['view_func', 'mapping', 'convert', 'default', 'plan'])
+
+# registry key for the @default_intent fallback
+_DEFAULT_INTENT = object()
+
+
+def _build_param_plan(view_func, mapping, convert, default):
+    """Precompute the per-argument slot plumbing for a view function.
+
+    Resolving the argspec, slot mapping, defaults and converter shorthands once
+    at decorator time keeps the per-request path down to a tight iteration over
+    a prebuilt tuple, with no inspect call or dict lookups per argument.
+    """
+    code = view_func.__code__
+    arg_names = code.co_varnames[:code.co_argcount]
+    plan = []
+    for arg_name in arg_names:
+        convert_func = convert.get(arg_name)
+        if convert_func in _converters:
+            convert_func = _converters[convert_func]
+        default_value = default.get(arg_name)
+        plan.append((arg_name,
+                     mapping.get(arg_name, arg_name),
+                     arg_name in default,
+                     default_value,
+                     callable(default_value),
+                     convert_func))
+    return tuple(plan)
+
 
 def find_flex():
-    if hasattr(current_app, 'flex'):
-        return getattr(current_app, 'flex')
-    else:
-        if hasattr(current_app, 'blueprints'):
-            blueprints = getattr(current_app, 'blueprints')
-            for blueprint_name in blueprints:
-                if hasattr(blueprints[blueprint_name], 'flex'):
-                    return getattr(blueprints[blueprint_name], 'flex')
+    # _flask_view_func stashes the serving Flex on g, so proxy dereferences
+    # within a request are a single attribute read
+    flex = getattr(g, '_flex', None)
+    if flex is not None:
+        return flex
+
+    flex = getattr(current_app, 'flex', None)
+    if flex is None and hasattr(current_app, 'blueprints'):
+        blueprints = getattr(current_app, 'blueprints')
+        for blueprint_name in blueprints:
+            if hasattr(blueprints[blueprint_name], 'flex'):
+                flex = getattr(blueprints[blueprint_name], 'flex')
+                # blueprints are frozen once the app is serving, so the scan
+                # only needs to happen once per app
+                current_app.flex = flex
+                break
+
+    if flex is not None:
+        g._flex = flex
+    return flex
 
 
 def dbgdump(obj):
-    if current_app.config.get('FLEX_PRETTY_DEBUG_LOGS', False):
-        indent = 2
+    if not logger.isEnabledFor(logging.DEBUG):
+        # skip the serialization (and the app config lookup) entirely when
+        # debug logging is off, which is the default
+        return
+    pretty = current_app.config.get('FLEX_PRETTY_DEBUG_LOGS', False)
+    if orjson is not None:
+        # go through the provider default so anything the stdlib path could
+        # log (Decimal, markup objects, ...) doesn't raise here
+        msg = orjson.dumps(obj, default=current_app.json.default,
+                           option=orjson.OPT_INDENT_2 if pretty else 0).decode('utf-8')
     else:
-        indent = None
-    msg = json.dumps(obj, indent=indent)
+        msg = json.dumps(obj, indent=2 if pretty else None)
     logger.debug(msg)
 
 
@@ -62,12 +143,8 @@ class Flex(object):
     def __init__(self, app=None, route=None, blueprint=None, path='templates.yaml'):
         self.app = app
         self._route = route
-        self._intent_view_funcs = {}
-        self._intent_converts = {}
-        self._intent_defaults = {}
-        self._intent_mappings = {}
+        self._intents = {}
         self._session_ended_view_func = None
-        self._default_intent_view_func = None
         if app is not None:
             self.init_app(app, path)
         elif blueprint is not None:
@@ -83,6 +160,12 @@ class Flex(object):
             Adds tabs and linebreaks to the Lex request and response printed to the debug log.
             This improves readability when printing to the console, but breaks formatting when logging to CloudWatch.
             Default: False
+
+        'FLEX_JINJA_BYTECODE_CACHE_DIR':
+
+            Directory in which compiled Jinja templates are cached on disk, so renders after a
+            process restart (e.g. a warm AWS Lambda start with '/tmp/jinja_bc') skip recompilation.
+            Default: None (no bytecode cache)
         """
 
         if self._route is None:
@@ -90,8 +173,16 @@ class Flex(object):
 
         app.flex = self
 
+        if orjson is not None and type(app.json) is DefaultJSONProvider:
+            # only swap in the orjson provider when the app is still on the
+            # stock one, so a custom provider's default handling survives
+            app.json = _OrjsonProvider(app)
+
         app.add_url_rule(self._route, view_func=self._flask_view_func, methods=['POST'])
         app.jinja_loader = ChoiceLoader([app.jinja_loader, YamlLoader(app, path)])
+        bytecode_cache_dir = app.config.get('FLEX_JINJA_BYTECODE_CACHE_DIR')
+        if bytecode_cache_dir:
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
 
     def init_blueprint(self, blueprint, path='templates.yaml'):
         """Initialize a Flask Blueprint, similar to init_app, but without the access
@@ -173,10 +264,8 @@ class Flex(object):
         """
 
         def decorator(f):
-            self._intent_view_funcs[intent_name] = f
-            self._intent_mappings[intent_name] = mapping
-            self._intent_converts[intent_name] = convert
-            self._intent_defaults[intent_name] = default
+            self._intents[intent_name] = _IntentSpec(
+                f, mapping, convert, default, _build_param_plan(f, mapping, convert, default))
 
             @wraps(f)
             def wrapper(*args, **kw):
@@ -188,7 +277,7 @@ class Flex(object):
 
     def default_intent(self, f):
         """Decorator routes any Lex IntentRequest that is not matched by any existing @flex.intent routing."""
-        self._default_intent_view_func = f
+        self._intents[_DEFAULT_INTENT] = _IntentSpec(f, {}, {}, {}, _build_param_plan(f, {}, {}, {}))
 
         @wraps(f)
         def wrapper(*args, **kw):
@@ -196,77 +285,94 @@ class Flex(object):
 
         return f
 
+    # All per-request fields live in one dict on flask.g, so each property
+    # access is a single g lookup plus a dict get instead of a proxy-backed
+    # attribute access per field.
+    @staticmethod
+    def _state_get(key, default=None):
+        state = getattr(g, '_flex_state', None)
+        if state is None:
+            return default
+        return state.get(key, default)
+
+    @staticmethod
+    def _state_set(key, value):
+        state = getattr(g, '_flex_state', None)
+        if state is None:
+            state = g._flex_state = {}
+        state[key] = value
+
     @property
     def current_intent(self):
-        return getattr(_app_ctx_stack.top, '_flex_intent', None)
+        return self._state_get('current_intent')
 
     @current_intent.setter
     def current_intent(self, value):
-        _app_ctx_stack.top._flex_intent = value
+        self._state_set('current_intent', value)
 
     @property
     def bot(self):
-        return getattr(_app_ctx_stack.top, '_flex_bot', {})
+        return self._state_get('bot', {})
 
     @bot.setter
     def bot(self, value):
-        _app_ctx_stack.top._flex_bot = value
+        self._state_set('bot', value)
 
     @property
     def version(self):
-        return getattr(_app_ctx_stack.top, '_flex_version', None)
+        return self._state_get('version')
 
     @version.setter
     def version(self, value):
-        _app_ctx_stack.top._flex_version = value
+        self._state_set('version', value)
 
     @property
     def user(self):
-        return getattr(_app_ctx_stack.top, '_flex_user', None)
+        return self._state_get('user')
 
     @user.setter
     def user(self, value):
-        _app_ctx_stack.top._flex_user = value
+        self._state_set('user', value)
 
     @property
     def transcript(self):
-        return getattr(_app_ctx_stack.top, '_flex_transcript', None)
+        return self._state_get('transcript')
 
     @transcript.setter
     def transcript(self, value):
-        _app_ctx_stack.top._flex_transcript = value
+        self._state_set('transcript', value)
 
     @property
     def source(self):
-        return getattr(_app_ctx_stack.top, '_flex_source', None)
+        return self._state_get('source')
 
     @source.setter
     def source(self, value):
-        _app_ctx_stack.top._flex_source = value
+        self._state_set('source', value)
 
     @property
     def output_mode(self):
-        return getattr(_app_ctx_stack.top, '_flex_output_mode', None)
+        return self._state_get('output_mode')
 
     @output_mode.setter
     def output_mode(self, value):
-        _app_ctx_stack.top._flex_output_mode = value
+        self._state_set('output_mode', value)
 
     @property
     def session(self):
-        return getattr(_app_ctx_stack.top, '_flex_session', {})
+        return self._state_get('session', {})
 
     @session.setter
     def session(self, value):
-        _app_ctx_stack.top._flex_session = value
+        self._state_set('session', value)
 
     @property
     def request(self):
-        return getattr(_app_ctx_stack.top, '_flex_request', {})
+        return self._state_get('request', {})
 
     @request.setter
     def request(self, value):
-        _app_ctx_stack.top._flex_request = value
+        self._state_set('request', value)
 
     def run_aws_lambda(self, event):
         """Invoke the Flex application from an AWS Lamnda function handler.
@@ -323,10 +429,17 @@ class Flex(object):
 
         # Convert the event provided by the AWS Lambda handler to a JSON
         # string that can be read as the body of a HTTP POST request.
-        body = json.dumps(event)
+        if orjson is not None:
+            body = orjson.dumps(event)
+        else:
+            body = json.dumps(event).encode('utf-8')
         environ['CONTENT_TYPE'] = 'application/json'
         environ['CONTENT_LENGTH'] = len(body)
-        environ['wsgi.input'] = StringIO(body)
+        environ['wsgi.input'] = BytesIO(body)
+
+        # We already hold the parsed event, so stash it on the environ and
+        # let _lex_request pick it up without re-parsing the body.
+        environ['flex.lex_event'] = event
 
         # Start response is a required callback that must be passed when
         # the application is invoked. It is used to set HTTP status and
@@ -349,9 +462,12 @@ class Flex(object):
             if not headers[0].startswith("2"):
                 raise AssertionError("Non-2xx from app: hdrs={}, body={}".format(headers, output))
 
-            # The Lambda handler expects a Python object that can be
-            # serialized as JSON, so we need to take the already serialized
-            # JSON and deserialize it.
+            # If the view handed the response dict back through the environ,
+            # return it directly; otherwise the Lambda handler expects a
+            # Python object, so deserialize the WSGI body.
+            lex_response = environ.get('flex.lex_response')
+            if lex_response is not None:
+                return lex_response
             return json.loads(output)
 
         finally:
@@ -365,8 +481,13 @@ class Flex(object):
 
     @staticmethod
     def _lex_request():
-        raw_body = flask_request.data
-        lex_request_payload = json.loads(raw_body)
+        # run_aws_lambda stashes the already-parsed event on the environ
+        lex_request_payload = flask_request.environ.get('flex.lex_event')
+        if lex_request_payload is None:
+            # use Flask's cached parse so a body another extension already
+            # decoded isn't parsed twice; force=True keeps the old behavior
+            # of accepting payloads regardless of Content-Type
+            lex_request_payload = flask_request.get_json(force=True, cache=True)
 
         return lex_request_payload
 
@@ -376,37 +497,46 @@ class Flex(object):
         Parse a given timestamp value, raising ValueError if None or Falsey
         """
         if timestamp:
-            try:
-                return aniso8601.parse_datetime(timestamp)
-            except AttributeError:
-                # raised by aniso8601 if raw_timestamp is not valid string
-                # in ISO8601 format
+            if isinstance(timestamp, (int, float)):
+                # numeric epochs can never parse as ISO8601, so don't raise
+                # through aniso8601 first
                 try:
                     return datetime.utcfromtimestamp(timestamp)
                 except:
                     # relax the timestamp a bit in case it was sent in millis
                     return datetime.utcfromtimestamp(timestamp / 1000)
+            try:
+                return _parse_datetime(timestamp)
+            except AttributeError:
+                # raised by aniso8601 if raw_timestamp is not valid string
+                # in ISO8601 format
+                pass
 
         raise ValueError('Invalid timestamp value! Cannot parse from either ISO8601 string or UTC timestamp.')
 
     def _flask_view_func(self, *args, **kwargs):
+        g._flex = self
         flex_payload = self._lex_request()
         dbgdump(flex_payload)
         request_body = models._Field(flex_payload)
 
-        self.current_intent = request_body.currentIntent
-        self.bot = request_body.bot
-        self.user = request_body.userId
-        self.transcript = request_body.inputTranscript
-        self.source = request_body.invocationSource
-        self.output_mode = request_body.outputDialogMode
-        self.version = request_body.messageVersion
-        self.session = request_body.sessionAttributes
-        self.request = request_body.requestAttributes
+        # build the whole request state in one assignment rather than going
+        # through nine property setters (and nine g lookups)
+        g._flex_state = {
+            'current_intent': request_body.currentIntent,
+            'bot': request_body.bot,
+            'user': request_body.userId,
+            'transcript': request_body.inputTranscript,
+            'source': request_body.invocationSource,
+            'output_mode': request_body.outputDialogMode,
+            'version': request_body.messageVersion,
+            'session': request_body.sessionAttributes,
+            'request': request_body.requestAttributes,
+        }
 
         result = None
 
-        if self._intent_view_funcs:
+        if self._intents:
             result = self._map_intent_to_view_func(self.current_intent)()
 
         if result is not None:
@@ -417,50 +547,28 @@ class Flex(object):
 
     def _map_intent_to_view_func(self, intent):
         """Provides appropriate parameters to the intent functions."""
-        if intent.name in self._intent_view_funcs:
-            view_func = self._intent_view_funcs[intent.name]
-        elif self._default_intent_view_func is not None:
-            view_func = self._default_intent_view_func
-        else:
+        spec = self._intents.get(intent.name) or self._intents.get(_DEFAULT_INTENT)
+        if spec is None:
             raise NotImplementedError('Intent "{}" not found and no default intent specified.'.format(intent.name))
 
-        argspec = inspect.getargspec(view_func)
-        arg_names = argspec.args
-        arg_values = self._map_params_to_view_args(intent.name, arg_names)
+        arg_values = self._map_params_to_view_args(spec.plan)
 
-        return partial(view_func, *arg_values)
+        return partial(spec.view_func, *arg_values)
 
-    def _map_params_to_view_args(self, view_name, arg_names):
+    def _map_params_to_view_args(self, plan):
         arg_values = []
-        convert = self._intent_converts.get(view_name)
-        default = self._intent_defaults.get(view_name)
-        mapping = self._intent_mappings.get(view_name)
-
         convert_errors = {}
 
-        request_data = {}
-        intent = self.current_intent
-        if intent.slots is not None:
-            for slot_key in intent.slots.keys():
-                slot_object = getattr(intent.slots, slot_key)
-                request_data[slot_key] = slot_object
+        # slots is already a dict (_Field extends dict), so read it directly
+        # instead of copying it into a throwaway lookup table
+        slots = self.current_intent.slots
 
-        for arg_name in arg_names:
-            param_or_slot = mapping.get(arg_name, arg_name)
-            arg_value = request_data.get(param_or_slot)
+        for arg_name, param_or_slot, has_default, default_value, default_is_callable, convert_func in plan:
+            arg_value = slots.get(param_or_slot) if slots is not None else None
             if arg_value is None or arg_value == '':
-                if arg_name in default:
-                    default_value = default[arg_name]
-                    if isinstance(default_value, collections.Callable):
-                        default_value = default_value()
-                    arg_value = default_value
-            elif arg_name in convert:
-                shorthand_or_function = convert[arg_name]
-                if shorthand_or_function in _converters:
-                    shorthand = shorthand_or_function
-                    convert_func = _converters[shorthand]
-                else:
-                    convert_func = shorthand_or_function
+                if has_default:
+                    arg_value = default_value() if default_is_callable else default_value
+            elif convert_func is not None:
                 try:
                     arg_value = convert_func(arg_value)
                 except Exception as e:
@@ -472,23 +580,43 @@ class Flex(object):
 
 class YamlLoader(BaseLoader):
 
+    # minimum seconds between stat calls on the templates file
+    _MTIME_CHECK_TTL = 1.0
+
     def __init__(self, app, path):
         self.path = app.root_path + os.path.sep + path
         self.mapping = {}
+        self.last_mtime = None
+        self._last_checked = 0.0
         self._reload_mapping()
 
     def _reload_mapping(self):
         if os.path.isfile(self.path):
             self.last_mtime = os.path.getmtime(self.path)
+            self._last_checked = time.monotonic()
             with open(self.path) as f:
                 self.mapping = yaml.safe_load(f.read())
 
+    def _maybe_reload(self):
+        # only stat the file once per TTL window so steady-state renders
+        # don't pay a syscall per template lookup
+        now = time.monotonic()
+        if now - self._last_checked > self._MTIME_CHECK_TTL:
+            self._last_checked = now
+            if self.last_mtime != os.path.getmtime(self.path):
+                self._reload_mapping()
+
+    def _up_to_date(self, template, source):
+        if not os.path.isfile(self.path):
+            return False
+        self._maybe_reload()
+        return self.mapping.get(template) is source
+
     def get_source(self, environment, template):
         if not os.path.isfile(self.path):
             return None, None, None
-        if self.last_mtime != os.path.getmtime(self.path):
-            self._reload_mapping()
+        self._maybe_reload()
         if template in self.mapping:
             source = self.mapping[template]
-            return source, None, lambda: source == self.mapping.get(template)
+            return source, None, partial(self._up_to_date, template, source)
         return TemplateNotFound(template)
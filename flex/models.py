@@ -1,9 +1,20 @@
+import logging
+
 import aniso8601
 from xml.etree import ElementTree
-from flask import json
+from flask import current_app, json, request as flask_request
 
+from . import logger
 from .core import session, dbgdump
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# local alias so the hot path skips the module attribute lookup
+_parse_datetime = aniso8601.parse_datetime
+
 
 class _Field(dict):
     """Container to represent Lex Request Data.
@@ -24,18 +35,24 @@ class _Field(dict):
     assert request_type_from_keys == request_type_from_attrs
     """
 
+    __slots__ = ()
+
     def __init__(self, request_json={}):
-        super(_Field, self).__init__(request_json)
-        for key, value in request_json.items():
-            if isinstance(value, dict):
-                value = _Field(value)
-            self[key] = value
+        # Nested dicts are wrapped lazily in __getattr__, so payload branches
+        # that view functions never touch are never walked.
+        dict.__init__(self, request_json)
 
     def __getattr__(self, attr):
-        # converts timestamp str to datetime.datetime object
-        if 'timestamp' in attr:
-            return aniso8601.parse_datetime(self.get(attr))
-        return self.get(attr)
+        value = dict.get(self, attr)
+        if type(value) is dict:
+            value = _Field(value)
+            dict.__setitem__(self, attr, value)
+        elif isinstance(value, str) and 'timestamp' in attr:
+            # converts timestamp str to datetime.datetime object, caching the
+            # parsed result so repeated access doesn't reparse
+            value = _parse_datetime(value)
+            dict.__setitem__(self, attr, value)
+        return value
 
     def __setattr__(self, key, value):
         self.__setitem__(key, value)
@@ -43,13 +60,15 @@ class _Field(dict):
 
 class _Response(object):
 
-    def __init__(self, action):
+    __slots__ = ('_json_default', '_response')
+
+    # static dialogAction keys, specialized per subclass at class-definition
+    # time and copied in one shot per instance
+    _TEMPLATE = {}
+
+    def __init__(self):
         self._json_default = None
-        self._response = {
-            'dialogAction': {
-                'type': action
-            }
-        }
+        self._response = {'dialogAction': dict(self._TEMPLATE)}
 
     def message(self, message):
         self._response['dialogAction']['message'] = _message(message)
@@ -85,55 +104,95 @@ class _Response(object):
 
     def render_response(self):
         response_wrapper = self._response
-        response_wrapper['sessionAttributes'] = dict(session)
+        session_attributes = session._get_current_object()
+        if logger.isEnabledFor(logging.DEBUG):
+            # snapshot the session so dbgdump can't observe it mid-mutation
+            session_attributes = dict(session_attributes)
+        response_wrapper['sessionAttributes'] = session_attributes
 
         dbgdump(response_wrapper)
 
+        environ = flask_request.environ
+        if 'flex.lex_event' in environ:
+            # invoked via run_aws_lambda; hand the dict back through the
+            # environ so the Lambda handler can skip the JSON round-trip
+            environ['flex.lex_response'] = response_wrapper
+            return ''
+        if orjson is not None:
+            # Flask accepts a bytes body, so skip the decode as well; go
+            # through the provider default so payloads the stdlib path could
+            # serialize (e.g. Decimal session values) don't raise here
+            return orjson.dumps(response_wrapper, default=current_app.json.default)
         return json.dumps(response_wrapper)
 
 
 class close(_Response):
 
+    __slots__ = ()
+
+    _TEMPLATE = {'type': 'Close'}
+
     def __init__(self, fulfilled):
-        super(close, self).__init__('Close')
+        super(close, self).__init__()
         self._response['dialogAction']['fulfillmentState'] = 'Fulfilled' if fulfilled else 'Failed'
 
 
 class confirm_intent(_Response):
 
+    __slots__ = ()
+
+    _TEMPLATE = {'type': 'ConfirmIntent'}
+
     def __init__(self, intent_name, slots):
-        super(confirm_intent, self).__init__('ConfirmIntent')
+        super(confirm_intent, self).__init__()
         self._response['dialogAction']['intentName'] = intent_name
         self._response['dialogAction']['slots'] = slots
 
 
 class delegate(_Response):
 
+    __slots__ = ()
+
+    _TEMPLATE = {'type': 'Delegate'}
+
     def __init__(self, slots):
-        super(delegate, self).__init__('Delegate')
+        super(delegate, self).__init__()
         self._response['dialogAction']['slots'] = slots
 
 
 class elicit_intent(_Response):
 
-    def __init__(self):
-        super(elicit_intent, self).__init__('ElicitIntent')
+    __slots__ = ()
+
+    _TEMPLATE = {'type': 'ElicitIntent'}
 
 
 class elicit_slot(_Response):
 
+    __slots__ = ()
+
+    _TEMPLATE = {'type': 'ElicitSlot'}
+
     def __init__(self, intent_name, slot_to_elicit, slots):
-        super(elicit_slot, self).__init__('ElicitSlot')
+        super(elicit_slot, self).__init__()
         self._response['dialogAction']['intentName'] = intent_name
         self._response['dialogAction']['slotToElicit'] = slot_to_elicit
         self._response['dialogAction']['slots'] = slots
 
 
 def _message(message):
+    stripped = message.lstrip()
+    if not stripped.startswith('<'):
+        # the common case: plain text, no XML parse needed
+        return {'contentType': 'PlainText', 'content': message}
+    if stripped.startswith('<speak>') and message.rstrip().endswith('</speak>'):
+        return {'contentType': 'SSML', 'content': message}
+    # markup that didn't match the fast check (e.g. <speak> with attributes);
+    # fall back to a real parse
     try:
         xmldoc = ElementTree.fromstring(message)
         if xmldoc.tag == 'speak':
             return {'contentType': 'SSML', 'content': message}
-    except (UnicodeEncodeError, ElementTree.ParseError) as e:
+    except (UnicodeEncodeError, ElementTree.ParseError):
         pass
     return {'contentType': 'PlainText', 'content': message}